@@ -3,19 +3,24 @@ docs:
 * http://initd.org/psycopg/docs/
 * http://initd.org/psycopg/docs/pool.html
 * http://initd.org/psycopg/docs/extras.html#dictionary-like-cursor
+* http://initd.org/psycopg/docs/extras.html#namedtuple-cursor
 """
 # Source: Daniel Kluver
 
+from collections import defaultdict
 from contextlib import contextmanager
+from functools import wraps
 from dotenv import find_dotenv, load_dotenv
-from flask import current_app
+from flask import current_app, g, has_request_context
 import logging
 import os
+import re
 import psycopg2
-from psycopg2.pool import ThreadedConnectionPool
-from psycopg2.extras import DictCursor
+import psycopg2.extensions
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+from psycopg2.extras import NamedTupleCursor
 from datetime import datetime
-import logging
+import time
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -25,6 +30,23 @@ if ENV_FILE:
 
 pool = None
 
+_WS_RE = re.compile(r"\s+")
+
+# hot INSERTs, prepared once per connection so Postgres parses and plans them
+# only once (session-level, so incompatible with PgBouncer transaction pooling)
+PREPARED_STATEMENTS = {
+    "create_user_account_stmt": "INSERT INTO users (username, email) VALUES ($1, $2) ON CONFLICT (email) DO UPDATE SET email = EXCLUDED.email RETURNING id",
+    "add_user_house_stmt": "INSERT INTO user_houses (user_id, house_id) VALUES ($1, $2)",
+    "insert_task_stmt": "INSERT INTO tasks (task_name, user_id, house_id, added_timestamp, due_date) VALUES ($1, $2, $3, $4, $5)",
+    "insert_restrictions_stmt": "INSERT INTO restrictions (house_id, user_id, diet_restrictions, schedule_restrictions) VALUES ($1, $2, $3, $4)",
+}
+
+
+class PreparingConnection(psycopg2.extensions.connection):
+    # set once PREPARED_STATEMENTS have been issued on this connection
+    statements_prepared = False
+
+
 DAY_NAMES = {
     0: "Monday",
     1: "Tuesday",
@@ -38,69 +60,143 @@ DAY_NAMES = {
 def setup():
     global pool
     DATABASE_URL = os.environ['DATABASE_URL']
-    current_app.logger.info(f"creating db connection pool")
-    pool = ThreadedConnectionPool(1, 100, dsn=DATABASE_URL, sslmode='require')
+    # keep DB_POOL_MAX summed across all gunicorn workers below Postgres'
+    # max_connections minus its reserved slots (or put PgBouncer in front)
+    pool_min = int(os.environ.get('DB_POOL_MIN', 5))
+    pool_max = int(os.environ.get('DB_POOL_MAX', 20))
+    current_app.logger.info(f"creating db connection pool ({pool_min}..{pool_max})")
+    pool = ThreadedConnectionPool(pool_min, pool_max, dsn=DATABASE_URL, sslmode='require',
+                                  connection_factory=PreparingConnection)
+
+
+def retry_on_db_error(attempts=3, delay=0.1):
+    """Retry a pool checkout a few times, backing off, before giving up."""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            for attempt in range(attempts):
+                try:
+                    return f(*args, **kwargs)
+                except (psycopg2.OperationalError, PoolError):
+                    if attempt == attempts - 1:
+                        raise
+                    time.sleep(delay * 2 ** attempt)
+        return wrapper
+    return decorator
+
+
+@retry_on_db_error()
+def _getconn():
+    return pool.getconn()
+
+
+def prepare_statements(connection):
+    if connection.statements_prepared:
+        return
+    with connection.cursor() as cur:
+        for name, query in PREPARED_STATEMENTS.items():
+            cur.execute(f"PREPARE {name} AS {query}")
+    connection.commit()
+    connection.statements_prepared = True
+
+
+def _checkout():
+    connection = _getconn()
+    try:
+        prepare_statements(connection)
+    except:
+        pool.putconn(connection, close=True)
+        raise
+    return connection
+
+
+# inside a request, every helper shares one connection checked out on first
+# use and returned by release_request_connection when the request ends
+def _request_connection():
+    if 'db_conn' not in g:
+        g.db_conn = _checkout()
+    return g.db_conn
+
+
+def release_request_connection(exception=None):
+    connection = g.pop('db_conn', None)
+    if connection is None:
+        return
+    try:
+        # also ends any read transaction left open by the helpers
+        connection.rollback()
+    except psycopg2.Error:
+        # the response is already built; don't turn it into a 500 just
+        # because the connection died afterwards
+        current_app.logger.exception("rollback failed releasing request connection")
+    finally:
+        # close a broken connection rather than leak its pool slot
+        pool.putconn(connection, close=bool(connection.closed))
 
 
 @contextmanager
 def get_db_connection():
+    if has_request_context():
+        connection = _request_connection()
+        try:
+            yield connection
+        except:
+            connection.rollback()
+            raise
+        return
+
+    # check out before the try so a failed getconn isn't masked by putconn
+    connection = _checkout()
     try:
-        connection = pool.getconn()
         yield connection
+    except:
+        # don't hand an aborted transaction to the next request
+        connection.rollback()
+        raise
     finally:
         pool.putconn(connection)
 
 
 @contextmanager
-def get_db_cursor(commit=False):
+def get_db_cursor(commit=False, cursor_factory=NamedTupleCursor):
+    # rows are namedtuples (row.task_name); pass psycopg2.extras.DictCursor
+    # as cursor_factory where dict-style access is needed
     with get_db_connection() as connection:
-        cursor = connection.cursor(cursor_factory=DictCursor)
+        cursor = connection.cursor(cursor_factory=cursor_factory)
         # cursor = connection.cursor()
         try:
             yield cursor
             if commit:
                 connection.commit()
+        except:
+            connection.rollback()
+            raise
         finally:
             cursor.close()
 
 
+# creates the account if the email is new; returns the user's id either way
 def create_user_account(username, email):
     with get_db_cursor(True) as cur:
-        current_app.logger.info("Adding user account %s", username)
-        cur.execute("INSERT INTO users (username, email) values (%s, %s)",
-                    (username, email))
-
-
-def check_user_exists(email):
-    with get_db_cursor() as cur:
-        cur.execute("SELECT username FROM users WHERE email = %s", (email,))
-        return cur.fetchone()
+        current_app.logger.debug("Upserting user account %s", username)
+        # DO UPDATE rather than DO NOTHING so RETURNING yields the existing row
+        cur.execute("EXECUTE create_user_account_stmt (%s, %s)", (username, email))
+        return cur.fetchone()[0]
 
 
+# returns the new house's id, or None if a house with that name already exists
 def create_house(house_name, creator_id):
-    stripped_name = house_name.strip()
-    formatted_name = ""
-    i = 0
-    while i < len(stripped_name):
-        if stripped_name[i] == " ":
-            formatted_name += " "
-            while i+1 < len(stripped_name) and stripped_name[i+1] == " ":
-                i += 1
-        else:
-            formatted_name += stripped_name[i]
-        i += 1
-        
+    # collapse runs of whitespace into single spaces
+    formatted_name = _WS_RE.sub(" ", house_name).strip()
+
     with get_db_cursor(True) as cur:
-        cur.execute("INSERT INTO houses (house_name) VALUES (%s) RETURNING house_id", (formatted_name,))
-        house_id = cur.fetchone()[0]
+        cur.execute("INSERT INTO houses (house_name) VALUES (%s) ON CONFLICT (house_name) DO NOTHING RETURNING house_id", (formatted_name,))
+        result = cur.fetchone()
+        if not result:
+            return None
+        house_id = result[0]
         cur.execute("INSERT INTO user_houses (user_id, house_id) VALUES (%s, %s)", (creator_id, house_id))
-
-
-
-def check_house_exists(house_name):
-    with get_db_cursor() as cur:
-        cur.execute("SELECT * FROM houses WHERE house_name = %s", (house_name,))
-        return cur.fetchone()
+    return house_id
 
 
 def get_houses():
@@ -110,14 +206,9 @@ def get_houses():
 
 def get_houses_to_join(user_id):
     with get_db_cursor() as cur:
-        cur.execute("SELECT DISTINCT house_name, house_id FROM houses LEFT JOIN user_houses USING (house_id) WHERE house_id NOT IN (SELECT house_id FROM user_houses WHERE user_id = %s)", (user_id, ))
+        cur.execute("SELECT h.house_name, h.house_id FROM houses h WHERE NOT EXISTS (SELECT 1 FROM user_houses uh WHERE uh.house_id = h.house_id AND uh.user_id = %s)", (user_id, ))
         return cur.fetchall()
     
-def get_user_id(user_email):
-    with get_db_cursor() as cur:
-        cur.execute("SELECT id FROM users WHERE email = %s", (user_email,))
-        return cur.fetchone()
-
 def get_user_houses(user_id):
     with get_db_cursor() as cur:
         cur.execute("SELECT house_name, house_id FROM user_houses LEFT JOIN houses USING (house_id) WHERE user_id = %s", (user_id,))
@@ -125,11 +216,7 @@ def get_user_houses(user_id):
     
 def add_user_house(user_id, house_id):
     with get_db_cursor(True) as cur:
-        cur.execute("INSERT INTO user_houses (user_id, house_id) VALUES (%s, %s)", (user_id, house_id))
-
-def remove_user_house(user_id, house_id):
-    with get_db_cursor(True) as cur:
-        cur.execute("DELETE FROM user_houses WHERE user_id = %s AND house_id = %s", (user_id, house_id))
+        cur.execute("EXECUTE add_user_house_stmt (%s, %s)", (user_id, house_id))
 
 # get users' names given a house id
 def get_house_members(house_id):
@@ -140,32 +227,39 @@ def get_house_members(house_id):
         members = cur.fetchall()
         return [member[0] for member in members] if members else ["No members"]
 
-# for leave button in user_home
-def leave_house(user_id, house_id):
+# members of several houses in one query, as {house_id: [username, ...]}
+def get_members_for_houses(house_ids):
+    with get_db_cursor() as cur:
+        cur.execute(
+            "SELECT uh.house_id, u.username FROM user_houses uh JOIN users u ON u.id = uh.user_id WHERE uh.house_id = ANY(%s)",
+            (list(house_ids),))
+        members = defaultdict(list)
+        for house_id, username in cur.fetchall():
+            members[house_id].append(username)
+        return members
+
+# for leave button in user_home: removes the user and, if they were the last
+# member, the house with its tasks and restrictions, all in one transaction
+def leave_house_atomic(user_id, house_id):
     with get_db_cursor(commit=True) as cur:
+        # lock the house row so concurrent leavers see each other's deletes
+        # (FOR UPDATE can't be combined with COUNT(*) directly)
+        cur.execute("SELECT house_id FROM houses WHERE house_id = %s FOR UPDATE", (house_id,))
         cur.execute("DELETE FROM user_houses WHERE user_id = %s AND house_id = %s", (user_id, house_id))
-        # Check if the user leaving is the last member of the house
         cur.execute("SELECT COUNT(*) FROM user_houses WHERE house_id = %s", (house_id,))
         count = cur.fetchone()[0]
         if count == 0:
+            cur.execute("DELETE FROM tasks WHERE house_id = %s", (house_id,))
+            cur.execute("DELETE FROM restrictions WHERE house_id = %s", (house_id,))
             cur.execute("DELETE FROM houses WHERE house_id = %s", (house_id,))
 
-def delete_tasks_by_house(house_id):
-    with get_db_cursor(commit=True) as cur:
-        cur.execute("DELETE FROM tasks WHERE house_id = %s", (house_id,))
-        # print(f"All tasks associated with house {house_id} deleted successfully.")
-
 def is_last_member(house_id):
     with get_db_cursor() as cur:
-        cur.execute("SELECT COUNT(*) FROM user_houses WHERE house_id = %s", (house_id,))
+        # only need to know whether there's exactly one member, so stop at two
+        cur.execute("SELECT COUNT(*) FROM (SELECT 1 FROM user_houses WHERE house_id = %s LIMIT 2) AS m", (house_id,))
         num_members = cur.fetchone()[0]
         return num_members == 1
 
-def delete_house(house_id):
-    with get_db_cursor(True) as cur:
-        cur.execute("DELETE FROM houses WHERE house_id = %s", (house_id,))
-
-
 # for assign_task page
 def get_member_id_dict(house_id):
     with get_db_cursor() as cur:
@@ -184,25 +278,32 @@ def get_house_name_by_id(house_id):
         else:
             return None  # id not found
 
+# for house page: name, members and tasks of a house in one round-trip
+def get_house_bundle(house_id):
+    with get_db_cursor() as cur:
+        cur.execute("""
+            WITH h AS (SELECT house_name FROM houses WHERE house_id = %(house_id)s),
+                 m AS (SELECT u.id, u.username FROM users u JOIN user_houses uh ON u.id = uh.user_id WHERE uh.house_id = %(house_id)s),
+                 t AS (SELECT task_id, task_name, user_id, due_date FROM tasks WHERE house_id = %(house_id)s)
+            SELECT (SELECT house_name FROM h) AS house_name, (SELECT json_agg(m) FROM m) AS members, (SELECT json_agg(t) FROM t) AS tasks
+        """, {"house_id": house_id})
+        house_name, members, tasks = cur.fetchone()
+        # psycopg2 decodes json columns; json_agg gives NULL for no rows
+        members = members or []
+        member_names = [member["username"] for member in members] or ["No members"]
+        member_id_dict = {member["username"]: member["id"] for member in members}
+        return house_name, member_names, member_id_dict, tasks or []
+
 def get_user_by_id(user_id):
     with get_db_cursor() as cur:
         cur.execute("SELECT username FROM users WHERE id = %s", (user_id, ))
         result = cur.fetchone()
         return result
     
-# for join button in user_home
-def join_house(user_id, house_id):
-    with get_db_cursor(True) as cur:
-        cur.execute("INSERT INTO user_houses (user_id, house_id) VALUES (%s, %s)", (user_id, house_id))
-
-def delete_house(house_id):
-    with get_db_cursor(commit=True) as cur:
-        cur.execute("DELETE FROM houses WHERE house_id = %s", (house_id,))
-
 # for assign-task page
 def insert_task(task_name, user_id, house_id, task_due_date):
     with get_db_cursor(True) as cur:
-        query = "INSERT INTO tasks (task_name, user_id, house_id, added_timestamp, due_date) VALUES (%s, %s, %s, %s, %s)"
+        query = "EXECUTE insert_task_stmt (%s, %s, %s, %s, %s)"
         cur.execute(query, (task_name, user_id, house_id, datetime.now(), task_due_date))
 
 # for delete task page
@@ -217,32 +318,26 @@ def delete_tasks_by_user_and_house(user_id, house_id):
         query = "DELETE FROM tasks WHERE user_id = %s AND house_id = %s"
         cur.execute(query, (user_id, house_id))
 
-def delete_restrictions_by_house(house_id):
-    with get_db_cursor(True) as cur:
-        query = "DELETE FROM restrictions WHERE house_id = %s"
-        cur.execute(query, (house_id,))
-
-def get_tasks_by_house_id(house_id):
+# for calendar in house page: tasks joined with their assignee in one query.
+# end_day is the due date rounded to midnight, rounding up for anything after
+# noon (exactly 12:00 still rounds down, hence the microsecond)
+def get_tasks_with_assignees(house_id):
     with get_db_cursor() as cur:
-        # print(house_id)
-        cur.execute("SELECT * FROM tasks WHERE house_id = %s", (house_id,))
-        tasks = cur.fetchall()
-        return tasks
+        cur.execute(
+            "SELECT t.task_id, t.task_name, u.username AS assignee, t.due_date, "
+            "date_trunc('day', t.due_date + interval '12 hours' - interval '1 microsecond') AS end_day "
+            "FROM tasks t JOIN users u ON u.id = t.user_id WHERE t.house_id = %s",
+            (house_id,))
+        return cur.fetchall()
 
+# (task_id, "<name> due MM/DD, H:MMAM") pairs for the task dropdowns;
+# FMHH12 drops the hour's leading zero like the old strftime().replace(" 0", " ")
 def get_tasks_with_due_dates(house_id):
-    formatted_tasks = []
-    
-    tasks = get_tasks_by_house_id(house_id)  
-
-    for task in tasks:
-        task_id = task["task_id"]
-        task_name = task["task_name"]
-        task_due_date = task["due_date"]
-        formatted_due_date = task_due_date.strftime("%m/%d, %I:%M%p").replace(" 0", " ")
-        formatted_task = (task_id, f"{task_name} due {formatted_due_date}")
-        formatted_tasks.append(formatted_task)
-
-    return formatted_tasks
+    with get_db_cursor() as cur:
+        cur.execute(
+            "SELECT task_id, task_name || ' due ' || to_char(due_date, 'MM/DD, FMHH12:MIAM') AS label FROM tasks WHERE house_id = %s",
+            (house_id,))
+        return cur.fetchall()
 
 # for edit task page
 def update_task(task_id, task_name, user_id, task_due_date):
@@ -256,10 +351,13 @@ def update_task(task_id, task_name, user_id, task_due_date):
 
 def insert_restrictions(house_id, user_id, dietary_restrictions, schedule_restrictions):
     with get_db_cursor(True) as cur:
-        query = "INSERT INTO restrictions (house_id, user_id, diet_restrictions, schedule_restrictions) VALUES (%s, %s, %s, %s)"
+        query = "EXECUTE insert_restrictions_stmt (%s, %s, %s, %s)"
         cur.execute(query, (house_id, user_id, dietary_restrictions, schedule_restrictions))
 
-def get_restrictions(house_id):
+# (username, diet, schedule) rows in the shape get_openai_weekly_menu expects
+def get_restrictions_with_usernames(house_id):
     with get_db_cursor() as cur:
-        cur.execute("SELECT * FROM restrictions WHERE house_id = %s", (house_id,))
+        cur.execute(
+            "SELECT u.username, r.diet_restrictions, r.schedule_restrictions FROM restrictions r JOIN users u ON u.id = r.user_id WHERE r.house_id = %s",
+            (house_id,))
         return cur.fetchall()
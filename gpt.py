@@ -1,6 +1,10 @@
 from dotenv import load_dotenv, find_dotenv
 from openai import OpenAI
+from cachetools import TTLCache
+import hashlib
+import json
 import os
+import threading
 
 ENV_FILE = find_dotenv()
 if ENV_FILE:
@@ -9,6 +13,11 @@ if ENV_FILE:
 api_key = os.environ.get('OPENAI_API_KEY')
 client = OpenAI(api_key=api_key)
 
+# generated menus keyed by (house_id, hash of members + restrictions); an hour
+# of reuse saves a multi-second, paid API call on every refresh
+_SCHEDULE_CACHE = TTLCache(maxsize=256, ttl=3600)
+_SCHEDULE_CACHE_LOCK = threading.Lock()
+
 
 def get_GPT_query_string(members_house, restrictions):
     house_members = members_house
@@ -84,3 +93,30 @@ def get_openai_weekly_menu(members_house, restrictions):
     )
 
     return completion.choices[0].message.content
+
+
+def _schedule_cache_key(house_id, members_house, restrictions):
+    rows = sorted(json.dumps(list(restriction), default=str) for restriction in restrictions)
+    payload = json.dumps([sorted(members_house), rows]).encode()
+    return house_id, hashlib.blake2b(payload).hexdigest()
+
+
+def get_cached_openai_weekly_menu(house_id, members_house, restrictions):
+    key = _schedule_cache_key(house_id, members_house, restrictions)
+    with _SCHEDULE_CACHE_LOCK:
+        if key in _SCHEDULE_CACHE:
+            return _SCHEDULE_CACHE[key]
+
+    menu = get_openai_weekly_menu(members_house, restrictions)
+    with _SCHEDULE_CACHE_LOCK:
+        _SCHEDULE_CACHE[key] = menu
+    return menu
+
+
+# call when a house's members or restrictions change
+def invalidate_weekly_menu(house_id):
+    # entering the cache's timer freezes its clock, and pop() tolerates keys
+    # that expired anyway, so this can't raise after the caller's db write
+    with _SCHEDULE_CACHE_LOCK, _SCHEDULE_CACHE.timer:
+        for key in [key for key in _SCHEDULE_CACHE if key[0] == house_id]:
+            _SCHEDULE_CACHE.pop(key, None)
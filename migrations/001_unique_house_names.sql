@@ -0,0 +1,27 @@
+-- Makes houses.house_name unique, which create_house's
+-- INSERT ... ON CONFLICT (house_name) requires. Only needed for databases
+-- created from a schema.sql older than the UNIQUE constraint; safe to rerun.
+--
+-- psql "$DATABASE_URL" -f migrations/001_unique_house_names.sql
+
+BEGIN;
+
+-- Existing duplicates would make the ALTER fail. Keep the oldest house under
+-- its name and rename the rest to "<name> (<house_id>)" so no members, tasks
+-- or restrictions are lost.
+UPDATE houses h
+SET house_name = left(h.house_name, 50 - length(' (' || h.house_id || ')')) || ' (' || h.house_id || ')'
+WHERE EXISTS (
+    SELECT 1 FROM houses older
+    WHERE older.house_name = h.house_name AND older.house_id < h.house_id
+);
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'houses_house_name_key') THEN
+        ALTER TABLE houses ADD CONSTRAINT houses_house_name_key UNIQUE (house_name);
+    END IF;
+END
+$$;
+
+COMMIT;
@@ -0,0 +1,16 @@
+-- Indexes on the foreign keys used by the joins and filters in data.py.
+-- user_houses(user_id) is already covered by its (user_id, house_id) primary
+-- key. Safe to rerun.
+--
+-- psql "$DATABASE_URL" -f migrations/002_foreign_key_indexes.sql
+
+CREATE INDEX IF NOT EXISTS user_houses_house_id_idx ON user_houses (house_id);
+CREATE INDEX IF NOT EXISTS tasks_house_id_idx ON tasks (house_id);
+CREATE INDEX IF NOT EXISTS tasks_user_id_house_id_idx ON tasks (user_id, house_id);
+CREATE INDEX IF NOT EXISTS restrictions_house_id_idx ON restrictions (house_id);
+
+-- rerun ANALYZE on its own after large data loads so the planner picks up
+-- fresh statistics
+ANALYZE user_houses;
+ANALYZE tasks;
+ANALYZE restrictions;
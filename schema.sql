@@ -1,3 +1,6 @@
+-- Creates a fresh database; then apply the scripts in migrations/ in order
+-- (indexes live there). Existing databases only need the migrations.
+
 CREATE TABLE users (
     id SERIAL PRIMARY KEY,
     username VARCHAR(255),
@@ -7,7 +10,7 @@ CREATE TABLE users (
 
 CREATE TABLE houses (
     house_id SERIAL PRIMARY KEY,
-    house_name VARCHAR(50) NOT NULL,
+    house_name VARCHAR(50) NOT NULL UNIQUE,
     added_timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP 
 );
 
@@ -2,7 +2,14 @@ from flask import Flask, render_template, request, redirect, flash, url_for, ses
 # kluver might want us to use psycopg2 instead
 from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
-from data import *
+from data import (
+    setup, release_request_connection, create_user_account, create_house,
+    get_houses, get_houses_to_join, get_user_houses, add_user_house,
+    leave_house_atomic, is_last_member, get_house_members, get_members_for_houses,
+    get_member_id_dict, get_house_bundle, get_tasks_with_assignees,
+    get_tasks_with_due_dates, insert_task, update_task, delete_task_by_id,
+    insert_restrictions, get_restrictions_with_usernames,
+)
 import os, json
 from os import environ as env
 from urllib.parse import quote_plus, urlencode
@@ -10,7 +17,7 @@ from functools import wraps
 from authlib.integrations.flask_client import OAuth
 from dotenv import find_dotenv, load_dotenv
 from datetime import datetime, timedelta
-from gpt import *
+from gpt import get_cached_openai_weekly_menu, invalidate_weekly_menu
 
 ENV_FILE = find_dotenv()
 if ENV_FILE:
@@ -23,6 +30,11 @@ bcrypt = Bcrypt(app)
 with app.app_context():
     setup()
 
+# return the request's shared db connection (see data.get_db_connection)
+@app.teardown_request
+def teardown_db_connection(exception):
+    release_request_connection(exception)
+
 oauth = OAuth(app)
 
 oauth.register(
@@ -78,11 +90,7 @@ def callback():
     session["user_email"] = user_email
     
 
-    if not check_user_exists(user_email):
-        create_user_account(username, user_email)
-        print("created account")
-
-    session["user_id"] = get_user_id(user_email)[0]
+    session["user_id"] = create_user_account(username, user_email)
     print(session["username"], session["user_email"])
     return redirect("/")
 
@@ -131,8 +139,7 @@ def user_home():
             pass
         else:
             return redirect("/user/home")
-        if not check_house_exists(house_name):
-            create_house(house_name, session["user_id"])
+        create_house(house_name, session["user_id"])
 
         return redirect("/user/home#load-section")
     else:
@@ -143,9 +150,14 @@ def user_home():
 
 @requires_auth
 @app.route("/join-house", methods=["POST"])
-def join_house():
+def join_house_route():
     data = request.get_json()
-    add_user_house(session["user_id"], data["house_id"])
+    try:
+        house_id = int(data["house_id"])
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'house_id must be an integer'}), 400
+    add_user_house(session["user_id"], house_id)
+    invalidate_weekly_menu(house_id)
 
     return jsonify({"result": "ok"})
 
@@ -154,17 +166,12 @@ def join_house():
 def leave_house_route():
     data = request.get_json()
     user_id = session.get('user_id')
-    house_id = data.get('house_id')
-
-    if is_last_member(house_id):
-        delete_tasks_by_house(house_id)
-        delete_restrictions_by_house(house_id)
-
-    leave_house(user_id, house_id)
-
-    if is_last_member(house_id):
-        delete_house(house_id)
-
+    try:
+        house_id = int(data["house_id"])
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'house_id must be an integer'}), 400
+    leave_house_atomic(user_id, house_id)
+    invalidate_weekly_menu(house_id)
     return jsonify({"result": "ok"})
 
 @requires_auth
@@ -174,16 +181,6 @@ def check_last_member():
     last_member_status = is_last_member(house_id)
     return jsonify({"is_last_member": last_member_status})
 
-
-# for join button in user home
-# @app.route('/join-house', methods=['POST'])
-# @requires_auth
-# def join_house_route():
-#     user_id = session.get('user_id')
-#     house_id = request.json.get('house_id')
-#     join_house(user_id, house_id) # add entry to user_houses
-#     return jsonify({'message': 'House joined successfully'})
-
 # browse existing houses page (unauthenticated users can view this)
 @app.route('/browse')
 def browse():
@@ -197,37 +194,39 @@ def get_members():
     members = get_house_members(house_id)
     return jsonify({'members': members})
 
+# members of several houses at once, e.g. /get-members-bulk?house_ids=1,2,3
+@app.route('/get-members-bulk')
+def get_members_bulk():
+    try:
+        house_ids = [int(house_id) for house_id in request.args.get('house_ids', '').split(',') if house_id.strip()]
+    except ValueError:
+        return jsonify({'error': 'house_ids must be comma-separated integers'}), 400
+    if not house_ids:
+        return jsonify({'members': {}})
+    members = get_members_for_houses(house_ids)
+    return jsonify({'members': {house_id: members.get(house_id, []) for house_id in house_ids}})
+
 
 # main house page (calendar w/ tasks, scheduling gpt)
 @requires_auth
 @app.route('/house/<int:house_id>')
 def house(house_id):
-    house_name = get_house_name_by_id(house_id)
-    members = get_house_members(house_id)
-    member_id_dict = get_member_id_dict(house_id)
-    house_tasks = get_tasks_by_house_id(house_id)
+    house_name, members, member_id_dict, house_tasks = get_house_bundle(house_id)
     print(house_tasks)
     return render_template('house.html', house_id=house_id, house_tasks=house_tasks, house_name=house_name, member_id_dict=member_id_dict, members=members, cur_user=session["username"])
 
-def day_rounder(t):
-    if t.hour < 12 or (t.hour == 12 and t.minute == 0 and t.second == 0 and t.microsecond == 0):
-        return t.replace(hour=0, minute=0, second=0, microsecond=0)
-    else:
-        rounded_up = t.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
-        return rounded_up
-    
 # for calendar in house page 
 @app.route("/get-tasks/<int:house_id>", methods=["GET"])
 def get_tasks(house_id):
-    tasks = get_tasks_by_house_id(house_id)
+    tasks = get_tasks_with_assignees(house_id)
     events = []
     for task in tasks:
         event = {
-            'title': task[1],  # task name
-            'assignee': get_user_by_id(task[2])[0],
-            'start': task[5],  # due date
-            'end': task[5] + timedelta(hours=1),  # add some time from start 
-            'end-day': day_rounder(task[5])
+            'title': task.task_name,
+            'assignee': task.assignee,
+            'start': task.due_date,
+            'end': task.due_date + timedelta(hours=1),  # add some time from start 
+            'end-day': task.end_day
         }
         events.append(event)
     # print(events)
@@ -297,6 +296,7 @@ def restrictions(house_id):
         dietary_restrictions = data.get('dietary_restrictions')
         schedule_restrictions = data.get('schedule_restrictions')
         insert_restrictions(house_id, user_id, dietary_restrictions, schedule_restrictions)
+        invalidate_weekly_menu(house_id)
         return redirect(url_for('house', house_id=house_id))
     elif request.method == "GET":
         return render_template('restrictions.html', house_id=house_id)
@@ -305,22 +305,14 @@ def restrictions(house_id):
 @requires_auth
 @app.route('/ai_schedule/<int:house_id>', methods=["GET"])
 def ai_schedule(house_id):
-    member_id_dict = get_member_id_dict(house_id)
     house_members = get_house_members(house_id)
-    restrictions = get_restrictions(house_id)
-
-    def get_member_by_id(member_id):
-        for key, value in member_id_dict.items():
-            if value == member_id:
-                return key
-
+    restrictions = get_restrictions_with_usernames(house_id)
     print(restrictions)
-    for i in range(len(restrictions)):
-        restrictions[i].pop(0)
-        restrictions[i].pop(1)
-        restrictions[i][0] = get_member_by_id(restrictions[i][0])
+    # hand the connection back before the slow OpenAI call so it isn't held
+    # idle in a transaction for seconds
+    release_request_connection()
 
-    show_schedule = get_openai_weekly_menu(house_members, restrictions)
+    show_schedule = get_cached_openai_weekly_menu(house_id, house_members, restrictions)
     return render_template('gpt.html', show_schedule=show_schedule, house_id=house_id)
 
 if __name__ == "__main__":